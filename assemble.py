@@ -2,10 +2,13 @@
 
 import argparse
 import collections
+import debuginfo
+import functools
 import golf
 import idata
 import io
 import json
+import keyword
 import os
 import re
 import string
@@ -219,36 +222,90 @@ def translate_pseudo_instr(instr_nr, instr, args):
     return [[instr, args],]
 
 
+# The environment source is evaluated in, built once. preprocess works on a copy.
+base_variables = dict(mem for mem in inspect.getmembers(math) if not mem[0].startswith("_"))
+base_variables.update({c: Reg(c) for c in string.ascii_lowercase})
+base_variables["pow"] = pow
+base_variables["math"] = math
+base_variables["data"] = Data
+
+line_re = re.compile(r"^([a-zA-Z_][a-zA-Z0-9_]+)\s*(.*)")
+simple_arg_re = re.compile(r"^\s*(?:(-?(?:0[xX][0-9a-fA-F]+|[1-9][0-9]*|0))|([a-zA-Z_][a-zA-Z0-9_]*))\s*$")
+
+
+@functools.lru_cache(maxsize=4096)
+def strip_comment(rest):
+    if "#" not in rest: return rest
+    if "'" not in rest and '"' not in rest: return rest[:rest.index("#")].rstrip()
+
+    # Reuse Python's tokenizer to correctly handle comments in strings, etc.
+    tokens = tokenize.tokenize(io.BytesIO(rest.encode("utf-8")).readline)
+    stripped_tokens = []
+    for typ, tok, _, _, _  in tokens:
+        if typ == tokenize.COMMENT: continue
+        stripped_tokens.append((typ, tok))
+    return tokenize.untokenize(stripped_tokens).decode("utf-8")
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_expr(expr):
+    # Like eval, ignore leading whitespace.
+    return compile(expr.lstrip(" \t"), "<string>", "eval")
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_simple_args(rest):
+    """Splits an argument list consisting only of integer literals and names, returning a tuple
+    of ints and names, or None if any argument is a more complex expression."""
+    if not rest.strip(): return ()
+
+    args = []
+    for arg in rest.split(","):
+        m = simple_arg_re.match(arg)
+        if m is None: return None
+        literal, name = m.groups()
+        if name is not None and keyword.iskeyword(name): return None
+        args.append(int(literal, 0) if literal is not None else name)
+
+    return tuple(args)
+
+
+def eval_args(rest, variables):
+    simple_args = parse_simple_args(rest)
+    if simple_args is not None and all(isinstance(arg, int) or arg in variables
+                                       for arg in simple_args):
+        return [arg if isinstance(arg, int) else variables[arg] for arg in simple_args]
+
+    return list(eval(compile_expr("(None, {})".format(rest)), variables)[1:])
+
+
 def preprocess(lines):
     lines = [l.rstrip() for l in lines]
-    data = [(lnr, l) for lnr, l in enumerate(lines)]
 
     # Handle line continuation.
     no_backslash = []
-    while data:
-        lnr, l = data.pop(0)
+    lnr = 0
+    while lnr < len(lines):
+        start, l = lnr, lines[lnr]
+        lnr += 1
 
         while l.endswith("\\"):
             l = l[:-1]
-            try:
-                _, nextl = data.pop(0)
-                l += nextl
-            except IndexError: break
-
-        no_backslash.append((lnr, l.strip()))
-
-    variables = dict(mem for mem in inspect.getmembers(math) if not mem[0].startswith("_"))
-    variables.update({c: Reg(c) for c in string.ascii_lowercase})
-    variables["pow"] = pow
-    variables["math"] = math
-    variables["data"] = Data
+            if lnr == len(lines): break
+            l += lines[lnr]
+            lnr += 1
+
+        no_backslash.append((start, l.strip()))
+
+    variables = dict(base_variables)
     num_instructions = 0
 
-    # Label pass.
+    # Label pass, parses every line into (lnr, ident, rest) with comments stripped.
+    parsed = []
     for lnr, l in no_backslash:
         if l.startswith("#") or not l: continue
 
-        parse = re.search("^([a-zA-Z_][a-zA-Z0-9_]+)\s*(.*)", l)
+        parse = line_re.match(l)
         if parse is None:
             raise SyntaxError("Syntax error on line {}:\n{}".format(lnr + 1, lines[lnr]))
 
@@ -264,37 +321,28 @@ def preprocess(lines):
                     "Duplicate label name on line {}:\n{}".format(lnr + 1, lines[lnr]))
 
             variables[ident] = Label(num_instructions, ident)
+            continue
 
-        elif not rest.startswith("="):
+        rest = strip_comment(rest)
+        if not rest.startswith("="):
             num_instructions += 1
 
+        parsed.append((lnr, ident, rest))
+
     # Read instructions and assignments.
     instructions = []
-    for lnr, l in no_backslash:
-        if l.startswith("#") or not l: continue
-
-        # Syntax already checked last time.
-        ident, rest = re.search("^([a-zA-Z_][a-zA-Z0-9_]+)\s*(.*)", l).groups()
-
-        # Strip comments (reuse Python's tokenizer to correctly handle comments in strings, etc).
-        tokens = tokenize.tokenize(io.BytesIO(rest.encode("utf-8")).readline)
-        stripped_tokens = []
-        for typ, tok, _, _, _  in tokens:
-            if typ == tokenize.COMMENT: continue
-            stripped_tokens.append((typ, tok))
-        rest = tokenize.untokenize(stripped_tokens).decode("utf-8")
-
+    for lnr, ident, rest in parsed:
         # Assignment.
         if rest.startswith("="):
             if ident in variables and isinstance(variables[ident], Label):
                 raise SyntaxError(
                     "Overwriting label name on line {}:\n{}".format(lnr + 1, lines[lnr]))
 
-            variables[ident] = eval(rest[1:], variables)
+            variables[ident] = eval(compile_expr(rest[1:]), variables)
 
         # Instruction.
-        elif not rest.startswith(":"):
-            args = list(eval("(None, {})".format(rest), variables)[1:])
+        else:
+            args = eval_args(rest, variables)
             check_instr_arguments(ident, args, lnr, lines)
             instructions.append(Instr(lnr, ident, args))
 
@@ -359,6 +407,7 @@ if __name__ == "__main__":
                         help="don't produce a binary, run source directly")
     parser.add_argument("-o", metavar="file", help="output file")
     parser.add_argument("-d", metavar="file", help="debug file")
+    parser.add_argument("-j", metavar="file", help="also export debug info as JSON")
     parser.set_defaults(run=False)
 
     args = parser.parse_args()
@@ -373,6 +422,10 @@ if __name__ == "__main__":
     if args.run:
         sys.exit(golf.GolfCPU(binary).run())
     else:
-        debug["lines"] = lines
         with open(args.o, "wb") as out_file: out_file.write(binary)
-        with open(args.d, "w") as dbg_file: json.dump(debug, dbg_file)
+        with open(args.d, "wb") as dbg_file:
+            debuginfo.write_debug(dbg_file, binary, debug, args.file, lines)
+
+        if args.j:
+            debug["lines"] = lines
+            with open(args.j, "w") as json_file: json.dump(debug, json_file)
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+import argparse
+import bisect
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+
+
+# Debug file layout, all integers little-endian u32:
+#
+#   magic, version, binary sha1, source sha1, num_offsets, num_labels, delta_len, path_len
+#   num_blocks x (first offset, first line, delta start)  sorted by offset
+#   num_labels x (label offset, name start, name len)  sorted by name
+#   delta_len bytes of offset deltas
+#   string blob: utf-8 source path followed by the label names
+#
+# The offset -> line table is split into blocks of BLOCK_SIZE instructions. Within a block
+# every entry after the first is stored as a varint offset delta and a zigzag varint line
+# delta, relative to the start of the deltas. Name starts are relative to the start of the
+# string blob. The source itself isn't stored, lines are read from the source file on demand
+# and only shown if its hash still matches. The source path is relative to the debug file,
+# and a source with the same name next to the debug file is tried as well.
+DEBUG_MAGIC = b"GOLFDBG\0"
+DEBUG_VERSION = 2
+HEADER_FMT = "<8sI20s20s4I"
+BLOCK_SIZE = 64
+
+
+def source_hash(lines):
+    return hashlib.sha1("\n".join(lines).encode("utf-8")).digest()
+
+
+def varint(n):
+    r = bytearray()
+    while n >= 0x80:
+        r.append(n & 0x7f | 0x80)
+        n >>= 7
+    r.append(n)
+    return bytes(r)
+
+
+def write_debug(f, binary, debug, source_path, lines):
+    """Writes the debug dictionary produced by assemble.assemble for binary, assembled from
+    the source lines read from source_path, to the binary file object f."""
+    offsets = sorted((k, v) for k, v in debug.items() if isinstance(k, int))
+    labels = sorted((name.encode("utf-8"), offset) for name, offset in debug["labels"].items())
+
+    blocks = []
+    deltas = b""
+    for i in range(0, len(offsets), BLOCK_SIZE):
+        block = offsets[i:i+BLOCK_SIZE]
+        blocks.append(struct.pack("<III", block[0][0], block[0][1], len(deltas)))
+        for (prev_offset, prev_lnr), (offset, lnr) in zip(block, block[1:]):
+            d = lnr - prev_lnr
+            deltas += varint(offset - prev_offset) + varint(2*d if d >= 0 else -2*d - 1)
+
+    try:
+        path = os.path.relpath(source_path, os.path.dirname(os.path.abspath(f.name)))
+    except (AttributeError, ValueError):
+        path = os.path.abspath(source_path)
+
+    blob = path.encode("utf-8")
+    path_len = len(blob)
+    label_table = []
+    for name, offset in labels:
+        label_table.append(struct.pack("<III", offset, len(blob), len(name)))
+        blob += name
+
+    f.write(struct.pack(HEADER_FMT, DEBUG_MAGIC, DEBUG_VERSION,
+                        hashlib.sha1(binary).digest(), source_hash(lines),
+                        len(offsets), len(labels), len(deltas), path_len))
+    f.write(b"".join(blocks))
+    f.write(b"".join(label_table))
+    f.write(deltas)
+    f.write(blob)
+
+
+class _Column:
+    """Read-only sequence view of one column of a fixed-size record table, for bisect."""
+
+    def __init__(self, buf, start, count, record_size, fmt):
+        self.buf = buf
+        self.start = start
+        self.count = count
+        self.record_size = record_size
+        self.fmt = fmt
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return struct.unpack_from(self.fmt, self.buf, self.start + i * self.record_size)[0]
+
+
+class _Names:
+    """Read-only sequence view of the label names, for bisect. UTF-8 byte order is code point
+    order, so the names compare the same as str."""
+
+    def __init__(self, debug_info):
+        self.debug_info = debug_info
+
+    def __len__(self):
+        return self.debug_info.num_labels
+
+    def __getitem__(self, i):
+        return self.debug_info._label_name(i)
+
+
+class DebugInfo:
+    """Memory-mapped view of a binary debug file. Nothing is parsed until it is looked up."""
+
+    def __init__(self, path):
+        self.dir = os.path.dirname(os.path.abspath(path))
+        with open(path, "rb") as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            self._read_header()
+        except Exception:
+            self.buf.close()
+            raise
+
+    def _read_header(self):
+        if len(self.buf) < struct.calcsize(HEADER_FMT):
+            raise RuntimeError("Truncated debug file.")
+
+        (magic, version, self.binary_hash, self.source_hash, self.num_offsets, self.num_labels,
+         delta_len, path_len) = struct.unpack_from(HEADER_FMT, self.buf)
+        if magic != DEBUG_MAGIC:
+            raise RuntimeError("Not a GOLF debug file.")
+        if version != DEBUG_VERSION:
+            raise RuntimeError("Unsupported debug file version.")
+
+        self.num_blocks = (self.num_offsets + BLOCK_SIZE - 1) // BLOCK_SIZE
+        self.blocks_start = struct.calcsize(HEADER_FMT)
+        self.labels_start = self.blocks_start + 12 * self.num_blocks
+        self.deltas_start = self.labels_start + 12 * self.num_labels
+        self.blob_start = self.deltas_start + delta_len
+        if len(self.buf) < self.blob_start + path_len:
+            raise RuntimeError("Truncated debug file.")
+
+        self.source_path = self._string(0, path_len)
+        self.lines = None
+
+    def close(self):
+        self.buf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _string(self, start, end):
+        if self.blob_start + end > len(self.buf):
+            raise RuntimeError("Truncated debug file.")
+        return self.buf[self.blob_start+start:self.blob_start+end].decode("utf-8")
+
+    def _label_name(self, i):
+        _, start, n = struct.unpack_from("<III", self.buf, self.labels_start + 12 * i)
+        return self._string(start, start + n)
+
+    def _varint(self, pos):
+        n = shift = 0
+        while True:
+            if pos >= self.blob_start:
+                raise RuntimeError("Truncated debug file.")
+            b = self.buf[pos]
+            pos += 1
+            n |= (b & 0x7f) << shift
+            shift += 7
+            if b < 0x80: return n, pos
+
+    def _block(self, i):
+        """Yields the (offset, line) entries of block i."""
+        offset, lnr, pos = struct.unpack_from("<III", self.buf, self.blocks_start + 12 * i)
+        pos += self.deltas_start
+        yield offset, lnr
+        for _ in range(min(BLOCK_SIZE, self.num_offsets - i * BLOCK_SIZE) - 1):
+            d_offset, pos = self._varint(pos)
+            d_lnr, pos = self._varint(pos)
+            offset += d_offset
+            lnr += d_lnr // 2 if d_lnr % 2 == 0 else -(d_lnr + 1) // 2
+            yield offset, lnr
+
+    def line_nr(self, offset):
+        """Returns the (0-based) source line of the instruction at or before offset, or None."""
+        firsts = _Column(self.buf, self.blocks_start, self.num_blocks, 12, "<I")
+        i = bisect.bisect_right(firsts, offset) - 1
+        if i < 0: return None
+
+        r = None
+        for instr_offset, lnr in self._block(i):
+            if instr_offset > offset: break
+            r = lnr
+        return r
+
+    def source_lines(self):
+        """Returns the source lines, or None if the source file is gone or has changed since it
+        was assembled."""
+        if self.lines is not None: return self.lines
+
+        for path in [os.path.join(self.dir, self.source_path),
+                     os.path.join(self.dir, os.path.basename(self.source_path))]:
+            try:
+                with open(path) as f:
+                    lines = [l.rstrip() for l in f]
+            except (OSError, UnicodeDecodeError):
+                continue
+            if source_hash(lines) == self.source_hash:
+                self.lines = lines
+                return lines
+
+        return None
+
+    def source_line(self, lnr):
+        """Returns source line lnr, or None if the source isn't available."""
+        lines = self.source_lines()
+        return None if lines is None else lines[lnr]
+
+    def label(self, name):
+        """Returns the offset of label name, or None."""
+        i = bisect.bisect_left(_Names(self), name)
+        if i < self.num_labels and self._label_name(i) == name:
+            return struct.unpack_from("<I", self.buf, self.labels_start + 12 * i)[0]
+        return None
+
+    def labels(self):
+        return {self._label_name(i): struct.unpack_from("<I", self.buf, self.labels_start + 12 * i)[0]
+                for i in range(self.num_labels)}
+
+    def to_json(self):
+        """Returns the debug info in the old JSON .dbg format. The lines are left out if the
+        source isn't available."""
+        debug = {}
+        for i in range(self.num_blocks):
+            for offset, lnr in self._block(i):
+                debug[str(offset)] = lnr
+        debug["labels"] = self.labels()
+        lines = self.source_lines()
+        if lines is not None: debug["lines"] = lines
+        return debug
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a GOLF debug file as JSON.")
+    parser.add_argument("file", help="debug file")
+    parser.add_argument("-o", metavar="file", help="output file (default stdout)")
+
+    args = parser.parse_args()
+
+    with DebugInfo(args.file) as debug_info:
+        debug = debug_info.to_json()
+        if "lines" not in debug:
+            print("Source file {} is missing or has changed, exporting without lines.".format(
+                  debug_info.source_path), file=sys.stderr)
+
+    if args.o is None:
+        json.dump(debug, sys.stdout)
+    else:
+        with open(args.o, "w") as out_file: json.dump(debug, out_file)
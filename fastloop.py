@@ -0,0 +1,229 @@
+import idata
+import struct
+
+
+# Register-only instructions that can't fail, as Python expressions over their operands. div
+# and divu are left out because they can raise on a zero divisor.
+ALU_EXPRS = {
+    "not":  "int(not {0})",
+    "or":   "{0} | {1}",
+    "xor":  "{0} ^ {1}",
+    "and":  "{0} & {1}",
+    "shl":  "shl({0}, {1})",
+    "shr":  "shr({0}, {1})",
+    "sal":  "sal({0}, {1})",
+    "sar":  "sar({0}, {1})",
+    "add":  "u({0} + {1})",
+    "sub":  "u({0} - {1})",
+    "cmp":  "int({0} == {1})",
+    "neq":  "int({0} != {1})",
+    "le":   "int(twos({0}) <  twos({1}))",
+    "leq":  "int(twos({0}) <= twos({1}))",
+    "leu":  "int({0} <  {1})",
+    "lequ": "int({0} <= {1})",
+    "mul":  "mul({0}, {1})",
+    "mulu": "mulu({0}, {1})",
+}
+
+MAX_LOOP_LEN = 64
+
+
+class Loop:
+    """A straight-line loop body starting at header, ending in a jump back to header, with a
+    single conditional exit. exit_on_zero tells whether the exit is taken when exit_arg is
+    zero."""
+
+    def __init__(self, header, body, exit_index, exit_arg, exit_on_zero):
+        self.header = header
+        self.body = body
+        self.exit_index = exit_index
+        self.exit_arg = exit_arg
+        self.exit_on_zero = exit_on_zero
+        self.cycles = sum(idata.cycle_counts[instr] for instr, _ in body)
+        self.written = sorted({reg for instr, args in body if instr in ALU_EXPRS
+                                   for reg in args[:idata.instr_signatures[instr][0]]})
+        self.regs = sorted({a for _, args in body for a in args if isinstance(a, str)})
+        self.compiled = None
+
+
+class LoopAnalyzer:
+    """Skips ahead over counted loops that only touch registers.
+
+    Every value computed in the loop body is tracked symbolically in terms of the registers at
+    the start of an iteration: ("const", c), ("aff", r, c) for r + c, ("zero", r, c, t) for
+    int((r + c == 0) == t) or None if unknown. Registers that end an iteration as ("aff", r, s)
+    of themselves are induction variables. If the exit condition depends only on an induction
+    variable, the trip count is solved for exactly and all iterations but the last are skipped,
+    either in closed form or by running the body compiled to Python. The last iteration, which
+    takes the exit, is left to the interpreter."""
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.loops = {}
+        self.env = {"u": cpu.u, "twos": cpu.twos, "shl": cpu.shl, "shr": cpu.shr,
+                    "sal": cpu.sal, "sar": cpu.sar, "mul": cpu.mul, "mulu": cpu.mulu}
+        self.funcs = {instr: eval("lambda a, b=0: " + expr.format("a", "b"), self.env)
+                      for instr, expr in ALU_EXPRS.items()}
+
+    def find_loop(self, header):
+        cpu = self.cpu
+        old_isp = cpu.isp
+        cpu.isp = header
+        body = []
+        exits = []
+
+        try:
+            while len(body) < MAX_LOOP_LEN:
+                instr, args = cpu.decode()
+                body.append((instr, args))
+                if instr in ALU_EXPRS: continue
+                if instr not in ("jz", "jnz") or isinstance(args[0], str): return None
+
+                if args[0] == header:
+                    if instr == "jz" and args[1] == 0: break
+                    exits.append((len(body) - 1, args[1], instr == "jnz"))
+                    break
+
+                exits.append((len(body) - 1, args[1], instr == "jz"))
+            else:
+                return None
+        except (KeyError, struct.error):
+            return None
+        finally:
+            end = cpu.isp
+            cpu.isp = old_isp
+
+        if len(exits) != 1: return None
+        exit_index, exit_arg, exit_on_zero = exits[0]
+        exit_target = body[exit_index][1][0]
+        if isinstance(exit_arg, int) or header < exit_target < end: return None
+
+        return Loop(header, body, exit_index, exit_arg, exit_on_zero)
+
+    def fold(self, instr, ops):
+        n_out = idata.instr_signatures[instr][0]
+        if all(op is not None and op[0] == "const" for op in ops):
+            r = self.funcs[instr](*(op[1] for op in ops))
+            return [("const", r)] if n_out == 1 else [("const", x) for x in r]
+
+        u = self.cpu.u
+        kinds = tuple(op and op[0] for op in ops)
+        if instr == "add" and kinds in (("aff", "const"), ("const", "aff")):
+            a, b = ops if kinds[0] == "aff" else ops[::-1]
+            return [("aff", a[1], u(a[2] + b[1]))]
+        if instr == "sub" and kinds == ("aff", "const"):
+            return [("aff", ops[0][1], u(ops[0][2] - ops[1][1]))]
+        if instr == "sub" and kinds == ("aff", "aff") and ops[0][1] == ops[1][1]:
+            return [("const", u(ops[0][2] - ops[1][2]))]
+        if instr in ("cmp", "neq") and kinds in (("aff", "const"), ("const", "aff")):
+            a, b = ops if kinds[0] == "aff" else ops[::-1]
+            return [("zero", a[1], u(a[2] - b[1]), instr == "cmp")]
+        if instr == "not" and kinds == ("aff",):
+            return [("zero", ops[0][1], ops[0][2], True)]
+        if instr == "not" and kinds == ("zero",):
+            return [("zero", ops[0][1], ops[0][2], not ops[0][3])]
+
+        return [None] * n_out
+
+    def symbolic(self, loop):
+        """Returns the symbolic register values at the end of an iteration, and the symbolic
+        value of the exit condition."""
+        regs = self.cpu.regs
+        sym = {reg: ("aff", reg, 0) for reg in loop.written}
+
+        def operand(a):
+            if not isinstance(a, str): return ("const", a)
+            return sym[a] if a in sym else ("const", regs[a])
+
+        cond = None
+        for i, (instr, args) in enumerate(loop.body):
+            if i == loop.exit_index: cond = operand(loop.exit_arg)
+            if instr not in ALU_EXPRS: continue
+
+            n_out, n_in = idata.instr_signatures[instr]
+            outs = self.fold(instr, [operand(a) for a in args[n_out:n_out+n_in]])
+            for reg, value in zip(args[:n_out], outs):
+                sym[reg] = value
+
+        return sym, cond
+
+    def trip_count(self, x0, step, exit_when_zero):
+        """Smallest j >= 0 such that x0 + j*step (mod 2**64) is zero (or non-zero), or None."""
+        u = self.cpu.u
+        if not exit_when_zero:
+            if x0 != 0: return 0
+            return 1 if step else None
+
+        if x0 == 0: return 0
+        if step == 0: return None
+
+        # Solve j*step = -x0 mod 2**64. step = g*odd with g a power of two.
+        g = step & -step
+        if u(-x0) % g: return None
+        m = (1 << 64) // g
+        return (u(-x0) // g) * pow(step // g, -1, m) % m
+
+    def compile(self, loop):
+        reads = loop.regs
+        name = lambda a: "r_" + a if isinstance(a, str) else str(a)
+
+        src = ["def loop(n, {}):".format(", ".join(map(name, reads))),
+               "    for _ in range(n):"]
+        for instr, args in loop.body:
+            if instr not in ALU_EXPRS: continue
+            n_out, n_in = idata.instr_signatures[instr]
+            src.append("        {} = {}".format(", ".join(map(name, args[:n_out])),
+                                                ALU_EXPRS[instr].format(*map(name, args[n_out:n_out+n_in]))))
+        src.append("    return ({},)".format(", ".join(map(name, loop.written))))
+
+        namespace = {}
+        exec("\n".join(src), self.env, namespace)
+        return reads, namespace["loop"]
+
+    def fast_forward(self):
+        """Called with isp at the target of a backwards jump. Skips ahead to the start of the
+        last iteration if the loop there can be proven to be counted, otherwise does nothing."""
+        cpu = self.cpu
+        header = cpu.isp
+        if header not in self.loops: self.loops[header] = self.find_loop(header)
+        loop = self.loops[header]
+        if loop is None: return
+
+        # Initial register values from the command line or API callers aren't wrapped and may
+        # be out of range, leave loops touching those alone.
+        if not all(0 <= cpu.regs[reg] < (1 << 64) for reg in loop.regs): return
+
+        sym, cond = self.symbolic(loop)
+        ivs = {reg: v[2] for reg, v in sym.items() if v is not None and v[:2] == ("aff", reg)}
+        closed = lambda v: v is not None and (v[0] == "const" or v[1] in ivs)
+
+        # Which registers are affine/unknown doesn't depend on their values, so neither does
+        # whether the exit condition is solvable.
+        if cond is None or cond[0] == "const" or not closed(cond):
+            self.loops[header] = None
+            return
+
+        truth = cond[3] if cond[0] == "zero" else False
+        x0 = cpu.u(cpu.regs[cond[1]] + cond[2])
+        j = self.trip_count(x0, ivs[cond[1]], truth != loop.exit_on_zero)
+        if not j: return
+
+        # Don't skip past the next checkpoint by more than an iteration.
+        if cpu.checkpoint_interval:
+            j = min(j, max(1, (cpu.next_checkpoint - cpu.cycle_count) // loop.cycles))
+
+        if all(closed(sym[reg]) for reg in loop.written):
+            prev = {reg: cpu.u(cpu.regs[reg] + (j - 1) * s) for reg, s in ivs.items()}
+            new = {}
+            for reg in loop.written:
+                v = sym[reg]
+                if   v[0] == "const": new[reg] = v[1]
+                elif v[0] == "aff":   new[reg] = cpu.u(prev[v[1]] + v[2])
+                else:                 new[reg] = int((cpu.u(prev[v[1]] + v[2]) == 0) == v[3])
+        else:
+            if loop.compiled is None: loop.compiled = self.compile(loop)
+            reads, func = loop.compiled
+            new = dict(zip(loop.written, func(j, *(cpu.regs[reg] for reg in reads))))
+
+        cpu.regs.update(new)
+        cpu.cycle_count += j * loop.cycles
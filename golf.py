@@ -7,14 +7,132 @@ import string
 import random
 import argparse
 import ast
+import debuginfo
+import fastloop
+import hashlib
+import os
+import zlib
+import math
+
+
+# Checkpoint file layout: magic, version, then a zlib-compressed body. Memory is
+# stored as a sparse list of PAGE_SIZE pages, all-zero pages are left out. Registers are
+# stored as length-prefixed signed integers, as values set from the command line aren't
+# wrapped to 64 bits.
+CHECKPOINT_MAGIC = b"GOLFCKPT"
+CHECKPOINT_VERSION = 6
+PAGE_SIZE = 4096
+
+# Output checker modes stored in a checkpoint.
+CHECKER_NONE = 0
+CHECKER_EXACT = 1
+CHECKER_WHITESPACE = 2
+
+
+class WrongOutput(Exception):
+    """Raised when the program output diverges from the expected output."""
+
+    def __init__(self, offset, reason):
+        super().__init__("Wrong output at byte offset {}: {}.".format(offset, reason))
+        self.offset = offset
+        self.reason = reason
+
+
+class OutputChecker:
+    """Incrementally compares output bytes against a binary expected output stream. With
+    ignore_whitespace, runs of whitespace only have to match in position, not in content, and
+    leading/trailing whitespace is ignored. Trailing whitespace is still cut off once it's longer
+    than both max_trailing_space and the expected trailing whitespace, which requires a seekable
+    expected stream."""
+
+    whitespace = b" \t\n\r\v\f"
+    max_trailing_space = 4096
+
+    def __init__(self, expected, ignore_whitespace=False):
+        self.expected = expected
+        self.ignore_whitespace = ignore_whitespace
+        self.expected_pos = 0
+        self.offset = 0
+        self.pending_space = 0
+        self.seen_token = False
+        self.space_limit = None
+
+    def read_expected(self):
+        r = self.expected.read(1)
+        self.expected_pos += len(r)
+        return r[0] if r else None
+
+    def skip(self, n):
+        while self.expected_pos < n:
+            r = self.expected.read(min(n - self.expected_pos, 1 << 16))
+            if not r: break
+            self.expected_pos += len(r)
+
+    def remaining_space(self):
+        """Returns the length of the rest of the expected output if it's only whitespace, or
+        infinity otherwise. Doesn't move the read position."""
+        pos = self.expected.tell()
+        n = 0
+        try:
+            while True:
+                r = self.expected.read(1 << 16)
+                if not r: return n
+                if r.lstrip(self.whitespace): return math.inf
+                n += len(r)
+        finally:
+            self.expected.seek(pos)
+
+    def write(self, b):
+        offset = self.offset
+        self.offset += 1
+
+        if not self.ignore_whitespace:
+            e = self.read_expected()
+            if e is None: raise WrongOutput(offset, "output longer than expected")
+            if e != b: raise WrongOutput(offset, "expected {!r}, got {!r}".format(chr(e), chr(b)))
+            return
+
+        if b in self.whitespace:
+            self.pending_space += 1
+            if self.pending_space > self.max_trailing_space:
+                if self.space_limit is None:
+                    self.space_limit = max(self.remaining_space(), self.max_trailing_space)
+                if self.pending_space > self.space_limit:
+                    raise WrongOutput(offset, "output longer than expected")
+            return
+
+        e = self.read_expected()
+        expected_space = False
+        while e is not None and e in self.whitespace:
+            expected_space = True
+            e = self.read_expected()
+
+        if e is None: raise WrongOutput(offset, "output longer than expected")
+        if self.seen_token and bool(self.pending_space) != expected_space:
+            raise WrongOutput(offset, "whitespace mismatch")
+        if e != b: raise WrongOutput(offset, "expected {!r}, got {!r}".format(chr(e), chr(b)))
+
+        self.pending_space = 0
+        self.seen_token = True
+        self.space_limit = None
+
+    def finish(self):
+        """Checks that no expected output remains once the program halts."""
+        e = self.read_expected()
+        while self.ignore_whitespace and e is not None and e in self.whitespace:
+            e = self.read_expected()
+
+        if e is not None: raise WrongOutput(self.offset, "output shorter than expected")
 
 
 class GolfCPU:
-    def __init__(self, binary, i=sys.stdin, o=sys.stdout):
+    def __init__(self, binary, i=sys.stdin, o=sys.stdout, checker=None, fast_loops=False):
         data_len = struct.unpack_from("<I", binary)[0]
+        self.binary_hash = hashlib.sha1(binary).digest()
         self.data = binary[4:4+data_len]
         self.instructions = binary[4+data_len:]
         self.isp = 0
+        self.instr_isp = 0
         self.regs = {k: 0 for k in string.ascii_lowercase}
         self.regs["z"] = 0x1000000000000000
         self.callstack = []
@@ -23,6 +141,27 @@ class GolfCPU:
         self.cycle_count = 0
         self.stdin = i
         self.stdout = o
+        self.stdin_pos = 0
+        self.stdout_pos = 0
+        self.stdout_bytes = 0
+        self.char_sizes = self.encoded_sizes(o)
+        self.checker = checker
+        self.checkpoint_file = None
+        self.checkpoint_interval = 0
+        self.next_checkpoint = 0
+        self.fast_loops = fastloop.LoopAnalyzer(self) if fast_loops else None
+
+    # Number of units (bytes, or characters for streams without an encoding) each output
+    # byte takes up in the output stream.
+    def encoded_sizes(self, o):
+        encoding = getattr(o, "encoding", None)
+        if encoding is None: return [1] * 256
+
+        sizes = []
+        for b in range(256):
+            try: sizes.append(len(chr(b).encode(encoding)))
+            except UnicodeEncodeError: sizes.append(0)
+        return sizes
 
     def unpack_imm(self, fmt):
         r = struct.unpack_from("<" + fmt, self.instructions, self.isp)[0]
@@ -74,6 +213,7 @@ class GolfCPU:
         if a == 0xffffffffffffffff:
             if width != 8: raise RuntimeError("May only use lw/sw for stdin/stdout.")
             r = self.stdin.read(1)
+            self.stdin_pos += len(r)
             return ord(r) if r else self.u(-1)
 
         if a >= 0x2000000000000000:
@@ -91,8 +231,11 @@ class GolfCPU:
     def store(self, a, b, width):
         if a == 0xffffffffffffffff:
             if width != 8: raise RuntimeError("May only use lw/sw for stdin/stdout.")
+            if self.checker is not None: self.checker.write(b & 0xff)
             self.stdout.write(chr(b & 0xff))
             self.stdout.flush()
+            self.stdout_pos += 1
+            self.stdout_bytes += self.char_sizes[b & 0xff]
             return
 
         fmts = {1: "B", 2: "S", 4: "I", 8: "Q"}
@@ -109,6 +252,176 @@ class GolfCPU:
                 self.heap += [0] * (a + width - len(self.heap))
             self.heap[a:a+width] = b
 
+    def set_checkpoint(self, path, interval):
+        """Automatically save the state to path every interval cycles."""
+        if interval <= 0: raise ValueError("Checkpoint interval must be positive.")
+        self.checkpoint_file = path
+        self.checkpoint_interval = interval
+        self.next_checkpoint = (self.cycle_count // interval + 1) * interval
+
+    def pack_memory(self, mem):
+        mem = bytes(mem)
+        zero_page = bytes(PAGE_SIZE)
+        pages = []
+        for start in range(0, len(mem), PAGE_SIZE):
+            page = mem[start:start+PAGE_SIZE]
+            if page != zero_page[:len(page)]:
+                pages.append(struct.pack("<Q", start // PAGE_SIZE) + page)
+
+        return struct.pack("<QQ", len(mem), len(pages)) + b"".join(pages)
+
+    def unpack_memory(self, body, offset):
+        length, num_pages = struct.unpack_from("<QQ", body, offset)
+        offset += 16
+        mem = [0] * length
+        for _ in range(num_pages):
+            start = struct.unpack_from("<Q", body, offset)[0] * PAGE_SIZE
+            end = min(start + PAGE_SIZE, length)
+            mem[start:end] = body[offset+8:offset+8+end-start]
+            offset += 8 + end - start
+
+        return mem, offset
+
+    def checker_mode(self):
+        if self.checker is None: return CHECKER_NONE
+        return CHECKER_WHITESPACE if self.checker.ignore_whitespace else CHECKER_EXACT
+
+    def pack_regs(self, regs):
+        r = []
+        for k in string.ascii_lowercase:
+            v = regs[k]
+            n = (v.bit_length() + 8) // 8
+            r.append(struct.pack("<I", n) + v.to_bytes(n, "little", signed=True))
+
+        return b"".join(r)
+
+    def unpack_regs(self, body, offset):
+        regs = {}
+        for k in string.ascii_lowercase:
+            n = struct.unpack_from("<I", body, offset)[0]
+            regs[k] = int.from_bytes(body[offset+4:offset+4+n], "little", signed=True)
+            offset += 4 + n
+
+        return regs, offset
+
+    def save_state(self, path):
+        """Writes the full machine state to path. The file is written atomically, so an
+        interrupted save never destroys the previous checkpoint."""
+        body = [self.binary_hash]
+        body.append(struct.pack("<QQQQQ", self.isp, self.cycle_count,
+                                self.stdin_pos, self.stdout_pos, self.stdout_bytes))
+        body.append(self.pack_regs(self.regs))
+        body.append(struct.pack("<Q", len(self.callstack)))
+        for isp, regs in self.callstack:
+            body.append(struct.pack("<Q", isp))
+            body.append(self.pack_regs(regs))
+        body.append(self.pack_memory(self.stack))
+        body.append(self.pack_memory(self.heap))
+
+        version, mt_state, gauss_next = random.getstate()
+        body.append(struct.pack("<I625I", version, *mt_state))
+        body.append(struct.pack("<?d", gauss_next is not None, gauss_next or 0.0))
+
+        if self.checker is None:
+            body.append(struct.pack("<BQQ?", CHECKER_NONE, 0, 0, False))
+        else:
+            body.append(struct.pack("<BQQ?", self.checker_mode(), self.checker.expected_pos,
+                                    self.checker.pending_space, self.checker.seen_token))
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(CHECKPOINT_MAGIC + struct.pack("<I", CHECKPOINT_VERSION))
+            f.write(zlib.compress(b"".join(body)))
+        os.replace(tmp_path, path)
+
+    def load_state(self, path):
+        """Restores the machine state saved by save_state. Input that was already consumed
+        before the checkpoint is skipped on stdin. If stdout is seekable and holds output
+        written after the checkpoint, it is truncated back to the checkpoint, otherwise that
+        output will be written again."""
+        with open(path, "rb") as f:
+            header = f.read(len(CHECKPOINT_MAGIC) + 4)
+            if header[:len(CHECKPOINT_MAGIC)] != CHECKPOINT_MAGIC:
+                raise RuntimeError("Not a GOLF checkpoint file.")
+            if struct.unpack_from("<I", header, len(CHECKPOINT_MAGIC))[0] != CHECKPOINT_VERSION:
+                raise RuntimeError("Unsupported checkpoint version.")
+            body = zlib.decompress(f.read())
+
+        if body[:20] != self.binary_hash:
+            raise RuntimeError("Checkpoint was made with a different binary.")
+
+        (self.isp, self.cycle_count, stdin_pos,
+         self.stdout_pos, self.stdout_bytes) = struct.unpack_from("<QQQQQ", body, 20)
+        offset = 60
+
+        self.regs, offset = self.unpack_regs(body, offset)
+
+        num_frames = struct.unpack_from("<Q", body, offset)[0]
+        offset += 8
+        self.callstack = []
+        for _ in range(num_frames):
+            isp = struct.unpack_from("<Q", body, offset)[0]
+            regs, offset = self.unpack_regs(body, offset + 8)
+            self.callstack.append((isp, regs))
+
+        self.stack, offset = self.unpack_memory(body, offset)
+        self.heap, offset = self.unpack_memory(body, offset)
+
+        mt_state = struct.unpack_from("<I625I", body, offset)
+        offset += struct.calcsize("<I625I")
+        has_gauss, gauss_next = struct.unpack_from("<?d", body, offset)
+        random.setstate((mt_state[0], mt_state[1:], gauss_next if has_gauss else None))
+        offset += struct.calcsize("<?d")
+
+        mode, expected_pos, pending_space, seen_token = struct.unpack_from("<BQQ?", body, offset)
+        if self.checker is not None:
+            if mode != self.checker_mode():
+                raise RuntimeError("Checkpoint was made with a different expected output mode.")
+            self.checker.skip(expected_pos)
+            self.checker.offset = self.stdout_pos
+            self.checker.pending_space = pending_space
+            self.checker.seen_token = seen_token
+
+        # Skip the input the program already read.
+        self.stdin_pos = 0
+        while self.stdin_pos < stdin_pos:
+            r = self.stdin.read(min(stdin_pos - self.stdin_pos, 1 << 16))
+            if not r: break
+            self.stdin_pos += len(r)
+
+        # Drop the output the program wrote after the checkpoint.
+        if self.stdout.seekable():
+            self.stdout.flush()
+            if self.stdout.seek(0, os.SEEK_END) > self.stdout_bytes:
+                self.stdout.seek(self.stdout_bytes)
+                self.stdout.truncate()
+
+        if self.checkpoint_interval:
+            self.set_checkpoint(self.checkpoint_file, self.checkpoint_interval)
+
+    def error_report(self, debug_info):
+        """Returns the source lines of the instruction being executed and of the active calls."""
+        if debug_info.binary_hash != self.binary_hash:
+            raise RuntimeError("Debug file was made for a different binary.")
+
+        def describe(what, lnr):
+            line = debug_info.source_line(lnr)
+            if line is None: return "{} line {} (source unavailable).".format(what, lnr + 1)
+            return "{} line {}:\n{}".format(what, lnr + 1, line)
+
+        report = []
+        lnr = debug_info.line_nr(self.instr_isp)
+        if lnr is not None:
+            report.append(describe("On", lnr))
+
+        # A frame stores the offset after its call instruction.
+        for isp, _ in reversed(self.callstack):
+            lnr = debug_info.line_nr(isp - 1)
+            if lnr is not None:
+                report.append(describe("Called from", lnr))
+
+        return "\n".join(report)
+
     def execute_instr(self, instr, args):
         if instr == "ret":
             if not self.callstack:
@@ -167,34 +480,47 @@ class GolfCPU:
 
         self.cycle_count += idata.cycle_counts[instr]
 
+    def decode(self):
+        """Decodes the instruction at isp and advances isp past it."""
+        instr = self.unpack_imm("I")
+        instr_id = instr & 0x7f
+        instr_flags = instr >> 7
+        instr_args = []
+        instr_name = idata.instr_names[instr_id]
+
+        if instr_name == "ret":
+            instr_args = [int(b) for b in bin(instr_flags)[2:][::-1]]
+            instr_args += [0] * (25 - len(instr_args))
+            instr_args += [1] # Always copy over z.
+            instr_args = [string.ascii_lowercase[i] for i, b in enumerate(instr_args) if b]
+
+        else:
+            while instr_flags:
+                arg_flag = instr_flags & 0x1f
+                instr_flags >>= 5
+
+                if arg_flag == 0: instr_args.append(0)
+                elif 1 <= arg_flag < 5:
+                    instr_args.append(self.u(self.unpack_imm("_bhiQ"[arg_flag])))
+                else:
+                    instr_args.append(string.ascii_lowercase[arg_flag - 5])
+
+            instr_args += [0] * (5 - len(instr_args))
+
+        return instr_name, instr_args
+
     def run(self):
         while self.isp < len(self.instructions):
-            instr = self.unpack_imm("I")
-            instr_id = instr & 0x7f
-            instr_flags = instr >> 7
-            instr_args = []
-            instr_name = idata.instr_names[instr_id]
-
-            if instr_name == "ret":
-                instr_args = [int(b) for b in bin(instr_flags)[2:][::-1]]
-                instr_args += [0] * (25 - len(instr_args))
-                instr_args += [1] # Always copy over z.
-                instr_args = [string.ascii_lowercase[i] for i, b in enumerate(instr_args) if b]
-
-            else:
-                while instr_flags:
-                    arg_flag = instr_flags & 0x1f
-                    instr_flags >>= 5
-
-                    if arg_flag == 0: instr_args.append(0)
-                    elif 1 <= arg_flag < 5:
-                        instr_args.append(self.u(self.unpack_imm("_bhiQ"[arg_flag])))
-                    else:
-                        instr_args.append(string.ascii_lowercase[arg_flag - 5])
-
-                instr_args += [0] * (5 - len(instr_args))
+            if self.checkpoint_interval and self.cycle_count >= self.next_checkpoint:
+                self.save_state(self.checkpoint_file)
+                self.set_checkpoint(self.checkpoint_file, self.checkpoint_interval)
+
+            self.instr_isp = self.isp
+            instr_name, instr_args = self.decode()
 
             if instr_name == "halt":
+                if self.checker is not None: self.checker.finish()
+
                 if isinstance(instr_args[0], str):
                     return self.regs[instr_args[0]]
 
@@ -202,9 +528,19 @@ class GolfCPU:
 
             self.execute_instr(instr_name, instr_args)
 
+            if (self.fast_loops is not None and instr_name in ("jz", "jnz") and
+                    self.isp <= self.instr_isp):
+                self.fast_loops.fast_forward()
+
         raise RuntimeError("Instruction pointer outside of executable memory!")
 
 
+def positive_int(s):
+    n = int(s)
+    if n <= 0: raise argparse.ArgumentTypeError("must be positive")
+    return n
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="GOLF virtual machine.")
     parser.add_argument("file", help="binary to run")
@@ -213,20 +549,69 @@ if __name__ == "__main__":
     parser.add_argument("-p", help="comma seperated list of registers to print at program exit")
     parser.add_argument("-d", dest="debug", action="store_true",
                         help="enable debug output")
-    parser.set_defaults(debug=False)
+    parser.add_argument("-f", dest="fast_loops", action="store_true",
+                        help="fast-forward through counted loops that only use registers")
+    parser.add_argument("-g", metavar="file",
+                        help="debug file used for error reporting (default: file.dbg)")
+    parser.add_argument("--checkpoint", metavar="file",
+                        help="checkpoint file to periodically save the VM state to")
+    parser.add_argument("--checkpoint-every", metavar="cycles", type=positive_int, default=10**8,
+                        help="cycles between checkpoints (default 100000000)")
+    parser.add_argument("--resume", metavar="file",
+                        help="resume execution from a checkpoint file")
+    parser.add_argument("--expect", metavar="file",
+                        help="abort with exit status 3 as soon as the output diverges from this file")
+    parser.add_argument("--ignore-whitespace", action="store_true",
+                        help="only compare --expect output up to whitespace differences")
+    parser.set_defaults(debug=False, fast_loops=False)
 
     args = parser.parse_args()
 
+    checker = None
+    if args.expect:
+        checker = OutputChecker(open(args.expect, "rb"), args.ignore_whitespace)
+
     with open(args.file, "rb") as binfile:
-        golf = GolfCPU(binfile.read())
+        golf = GolfCPU(binfile.read(), checker=checker, fast_loops=args.fast_loops)
+
+    if args.checkpoint:
+        golf.set_checkpoint(args.checkpoint, args.checkpoint_every)
 
-    if args.reg is not None:
+    if args.resume:
+        try:
+            golf.load_state(args.resume)
+        except (OSError, RuntimeError, zlib.error, struct.error) as e:
+            parser.error("can't resume from {}: {}".format(args.resume, e))
+    elif args.reg is not None:
         for assignment in args.reg:
-            reg, val = assignment.split("=")
-            val = ast.literal_eval(val)
+            reg, _, val = assignment.partition("=")
+            try:
+                val = ast.literal_eval(val)
+            except (ValueError, SyntaxError):
+                val = None
+            if reg not in golf.regs or not isinstance(val, int) or isinstance(val, bool):
+                parser.error("invalid register assignment: {}".format(assignment))
             golf.regs[reg] = val
 
-    ret = golf.run()
+    try:
+        ret = golf.run()
+    except WrongOutput as e:
+        print()
+        print("{} Execution aborted after {} cycles.".format(e, golf.cycle_count))
+        sys.exit(3)
+    except (RuntimeError, ZeroDivisionError) as e:
+        print()
+        print("Error after {} cycles: {}".format(golf.cycle_count, e))
+        if args.g is None: args.g = os.path.splitext(args.file)[0] + ".dbg"
+        if os.path.exists(args.g):
+            try:
+                with debuginfo.DebugInfo(args.g) as debug_info:
+                    report = golf.error_report(debug_info)
+            except (OSError, RuntimeError, ValueError, IndexError, struct.error,
+                    UnicodeDecodeError) as dbg_error:
+                report = "Could not read debug file {}: {}".format(args.g, dbg_error)
+            print(report)
+        sys.exit(1)
 
     if args.p:
         regs = args.p.split(",")